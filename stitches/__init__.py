@@ -1,6 +1,7 @@
 """ Stitches module """
 
 from stitches.connection import Connection
+from stitches.resources import ResourceManager
 from stitches.expect import ExpectFailed, Expect
 from stitches.structure import Structure
 
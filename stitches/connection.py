@@ -3,6 +3,8 @@ L{Connection}.
 """
 
 import paramiko
+import contextlib
+import threading
 import time
 import subprocess
 import os
@@ -12,28 +14,98 @@ import string
 import logging
 import socket
 
+# Lazy resources in the closing order
+RESOURCES = ('rpyc', 'sftp', 'channel', 'cli', 'pbm')
+# Resources which stop working when the given one is closed
+DEPENDENTS = {'cli': ('rpyc', 'sftp', 'channel'),
+              'pbm': ('rpyc',)}
+# Resources losing their state (shell session, remote objects) on reopening
+STATEFUL = ('channel', 'rpyc')
+
+
 class StitchesConnectionException(Exception):
     """ StitchesConnection Exception """
     pass
 
 def lazyprop(func):
     """ Create lazy property """
-    attr_name = '_lazy_' + func.__name__
+    name = func.__name__
+    attr_name = '_lazy_' + name
     @property
     def _lazyprop(self):
         """ Create lazy property """
-        if not hasattr(self, attr_name):
-            setattr(self, attr_name, func(self))
-        return getattr(self, attr_name)
+        manager = self.resource_manager
+        with self.resource_lock:
+            if not hasattr(self, attr_name):
+                value = func(self)
+                setattr(self, attr_name, value)
+                if manager is not None and value is not None:
+                    manager.opened(self, name)
+            elif manager is not None:
+                manager.touch(self, name)
+            return getattr(self, attr_name)
     return _lazyprop
 
 
+class TailBuffer(object):
+    """
+    Bytes buffer keeping at most limit last bytes written
+    """
+    def __init__(self, limit=None):
+        """
+        Create buffer
+
+        @param limit: maximum number of bytes to keep, None for unlimited
+        @type limit: int
+        """
+        self.limit = limit
+        self.data = bytearray()
+
+    def write(self, chunk):
+        """
+        Append data dropping the oldest bytes over the limit
+
+        @param chunk: data to append
+        @type chunk: bytes
+        """
+        self.data += chunk
+        if self.limit is not None and len(self.data) > self.limit:
+            del self.data[:len(self.data) - self.limit]
+
+    def getvalue(self):
+        """
+        @return: data kept
+        @rtype: bytes
+        """
+        return bytes(self.data)
+
+
+def read_tail(fileobj, limit=None):
+    """
+    Read file object till the end keeping at most limit last bytes
+
+    @param fileobj: file object to read
+    @type fileobj: file
+
+    @param limit: maximum number of bytes to keep, None for unlimited
+    @type limit: int
+
+    @return: data read
+    @rtype: bytes
+    """
+    buf = TailBuffer(limit)
+    for chunk in iter(lambda: fileobj.read(16384), b''):
+        buf.write(chunk)
+    return buf.getvalue()
+
+
 class Connection(object):
     """
     Stateful object to represent connection to the host
     """
     def __init__(self, instance, username="root", key_filename=None,
-                 timeout=10, output_shell=False, disable_rpyc=False):
+                 timeout=10, output_shell=False, disable_rpyc=False,
+                 resource_manager=None, max_output=None):
         """
         Create connection object
 
@@ -53,6 +125,16 @@ class Connection(object):
         @param output_shell: write output from this connection to standard
                              output
         @type output_shell: bool
+
+        @param disable_rpyc: do not use plumbum/rpyc
+        @type disable_rpyc: bool
+
+        @param resource_manager: manager capping open transports/sessions
+        @type resource_manager: L{ResourceManager}
+
+        @param max_output: keep at most this number of bytes in
+                           last_stdout/last_stderr, None for unlimited
+        @type max_output: int
         """
         self.logger = logging.getLogger('stitches.connection')
 
@@ -93,6 +175,13 @@ class Connection(object):
             self.key_filename = key_filename
         self.disable_rpyc = disable_rpyc
         self.timeout = timeout
+        self.resource_manager = resource_manager
+        self.max_output = max_output
+        # guards opening/closing of lazy resources and pins
+        self.resource_lock = threading.RLock()
+        self.pins = {}
+        # channels of commands started by exec_command
+        self.exec_channels = []
 
         # debugging buffers
         self.last_command = ""
@@ -152,7 +241,12 @@ class Connection(object):
 
     @lazyprop
     def sftp(self):
-        """ sftp lazy property """
+        """
+        sftp lazy property
+
+        Wrap long transfers in C{pin('sftp')} so the session is not closed
+        by L{ResourceManager} in the middle
+        """
         return self.cli.open_sftp()
 
     @lazyprop
@@ -238,30 +332,154 @@ t.start()
         """
         self.disconnect()
 
+    def is_connected(self):
+        """
+        Check if any resource of the connection is open
+
+        @rtype: bool
+        """
+        return any(hasattr(self, '_lazy_' + name) for name in RESOURCES)
+
+    @contextlib.contextmanager
+    def pin(self, name):
+        """
+        Protect the resource (and the ones it depends on) from being closed
+        by L{ResourceManager} while in use
+
+        @param name: resource name ('cli', 'sftp', 'channel', 'pbm', 'rpyc')
+        @type name: str
+        """
+        with self.resource_lock:
+            self.pins[name] = self.pins.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            with self.resource_lock:
+                self.pins[name] -= 1
+                if hasattr(self, '_lazy_' + name) and \
+                        self.resource_manager is not None:
+                    self.resource_manager.touch(self, name)
+
+    def _closes(self, name):
+        """
+        List opened resources closed together with the resource
+
+        @param name: resource name
+        @type name: str
+
+        @rtype: list
+        """
+        return [res for res in (name,) + DEPENDENTS.get(name, ())
+                if getattr(self, '_lazy_' + res, None) is not None]
+
+    def _exec_running(self):
+        """
+        Check if output of any exec_command is still being produced or read
+
+        @rtype: bool
+        """
+        rpyc_channel = getattr(self.stdout_rpyc, 'channel', None)
+        self.exec_channels = [
+            chan for chan in self.exec_channels
+            if not chan.closed and
+            (not chan.eof_received or chan.recv_ready() or
+             chan.recv_stderr_ready())]
+        # rpyc server channel lives as long as rpyc itself
+        return any(chan is not rpyc_channel for chan in self.exec_channels)
+
+    def is_busy(self, name):
+        """
+        Check if closing the resource would close a pinned one or a running
+        exec_command
+
+        @param name: resource name
+        @type name: str
+
+        @rtype: bool
+        """
+        with self.resource_lock:
+            if name == 'cli' and self._exec_running():
+                return True
+            return any(self.pins.get(res) for res in
+                       (name,) + DEPENDENTS.get(name, ()))
+
+    def is_stateful(self, name):
+        """
+        Check if closing the resource would lose a shell session or remote
+        objects
+
+        @param name: resource name
+        @type name: str
+
+        @rtype: bool
+        """
+        with self.resource_lock:
+            return any(res in STATEFUL for res in self._closes(name))
+
+    def _close_one(self, name):
+        """
+        Close the resource (if it was opened), forget it even if closing
+        fails
+
+        @param name: resource name
+        @type name: str
+        """
+        attr_name = '_lazy_' + name
+        if not hasattr(self, attr_name):
+            return
+        resource = getattr(self, attr_name)
+        delattr(self, attr_name)
+        if self.resource_manager is not None:
+            self.resource_manager.released(self, name)
+        if name == 'cli':
+            self.exec_channels = []
+        try:
+            if name == 'rpyc':
+                rpyc_files = (self.stdin_rpyc, self.stdout_rpyc,
+                              self.stderr_rpyc)
+                self.stdin_rpyc, self.stdout_rpyc, self.stderr_rpyc = \
+                    None, None, None
+                for fileobj in rpyc_files:
+                    if fileobj is not None:
+                        fileobj.close()
+        finally:
+            if resource is not None:
+                resource.close()
+
+    def close_resource(self, name):
+        """
+        Close the resource (if it was opened) and everything depending on it,
+        it will be reopened on next access. Failures are logged, all the
+        resources are closed anyway.
+
+        @param name: resource name ('cli', 'sftp', 'channel', 'pbm', 'rpyc')
+        @type name: str
+
+        @return: True if everything was closed without errors
+        @rtype: bool
+        """
+        success = True
+        with self.resource_lock:
+            for res in DEPENDENTS.get(name, ()) + (name,):
+                try:
+                    self._close_one(res)
+                except Exception as err:
+                    self.logger.warning("Failed to close %s of %s: %s",
+                                        res, self.hostname, err)
+                    success = False
+        return success
+
     def disconnect(self):
         """
         Close the connection
+
+        @return: True if everything was closed without errors
+        @rtype: bool
         """
-        if hasattr(self, '_lazy_sftp'):
-            if self.sftp is not None:
-                self.sftp.close()
-            delattr(self, '_lazy_sftp')
-        if hasattr(self, '_lazy_channel'):
-            if self.channel is not None:
-                self.channel.close()
-            delattr(self, '_lazy_channel')
-        if hasattr(self, '_lazy_cli'):
-            if self.cli is not None:
-                self.cli.close()
-            delattr(self, '_lazy_cli')
-        if hasattr(self, '_lazy_pbm'):
-            if self.pbm is not None:
-                self.pbm.close()
-            delattr(self, '_lazy_pbm')
-        if hasattr(self, '_lazy_rpyc'):
-            if self.rpyc is not None:
-                self.rpyc.close()
-            delattr(self, '_lazy_rpyc')
+        success = True
+        for name in RESOURCES:
+            success = self.close_resource(name) and success
+        return success
 
     def exec_command(self, command, bufsize=-1, get_pty=False):
         """
@@ -283,7 +501,11 @@ t.start()
         @raise SSHException: if the server fails to execute the command
         """
         self.last_command = command
-        return self.cli.exec_command(command, bufsize, get_pty=get_pty)
+        with self.resource_lock:
+            files = self.cli.exec_command(command, bufsize, get_pty=get_pty)
+            # keeps cli busy for ResourceManager until output is read
+            self.exec_channels.append(files[1].channel)
+        return files
 
     def recv_exit_status(self, command, timeout=10, get_pty=False):
         """
@@ -303,17 +525,30 @@ t.start()
         """
         status = None
         self.last_command = command
-        stdin, stdout, stderr = self.cli.exec_command(command, get_pty=get_pty)
-        if stdout and stderr and stdin:
-            for _ in range(timeout):
-                if stdout.channel.exit_status_ready():
-                    status = stdout.channel.recv_exit_status()
-                    self.last_stdout = stdout.read()
-                    self.last_stderr = stderr.read()
-                    break
-                time.sleep(1)
-
-            stdin.close()
-            stdout.close()
-            stderr.close()
+        with self.pin('cli'):
+            stdin, stdout, stderr = self.cli.exec_command(command,
+                                                          get_pty=get_pty)
+            if stdout and stderr and stdin:
+                out = TailBuffer(self.max_output)
+                err = TailBuffer(self.max_output)
+                chan = stdout.channel
+                for _ in range(timeout):
+                    # drain output while waiting so it is never buffered
+                    # in full
+                    while chan.recv_ready():
+                        out.write(chan.recv(16384))
+                    while chan.recv_stderr_ready():
+                        err.write(chan.recv_stderr(16384))
+                    if chan.exit_status_ready():
+                        status = chan.recv_exit_status()
+                        out.write(read_tail(stdout, self.max_output))
+                        err.write(read_tail(stderr, self.max_output))
+                        self.last_stdout = out.getvalue()
+                        self.last_stderr = err.getvalue()
+                        break
+                    time.sleep(1)
+
+                stdin.close()
+                stdout.close()
+                stderr.close()
         return status
@@ -0,0 +1,286 @@
+"""
+L{ResourceManager}: bounded pool of connection resources
+"""
+
+import atexit
+import collections
+import logging
+import threading
+import time
+import weakref
+
+from stitches.connection import DEPENDENTS
+
+# Objects owning an ssh transport (paramiko thread or ssh process)
+TRANSPORTS = ('cli', 'pbm')
+# Objects riding on top of a transport
+SESSIONS = ('sftp', 'channel', 'rpyc')
+# Resources which have to be alive for the given resource to work
+PARENTS = dict((name, tuple(parent for parent in sorted(DEPENDENTS)
+                            if name in DEPENDENTS[parent]))
+               for name in SESSIONS)
+
+
+# Managers which may have a running reaper
+_MANAGERS = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_reapers():
+    """
+    Stop reapers before interpreter shutdown freezes them (possibly holding
+    the manager lock needed by Structure.__del__)
+    """
+    for manager in list(_MANAGERS):
+        manager.stop()
+
+
+def _reaper(manager_ref, stop):
+    """
+    Periodically reap idle resources until the manager has nothing open
+
+    @param manager_ref: weak reference to the manager
+    @type manager_ref: weakref.ref
+
+    @param stop: event to stop reaping
+    @type stop: threading.Event
+    """
+    while True:
+        manager = manager_ref()
+        if manager is None:
+            return
+        interval = manager.idle_timeout / 2.0
+        manager.reap_idle()
+        with manager.lock:
+            if not manager.resources:
+                manager.reaper = None
+                return
+        del manager
+        stop.wait(interval)
+        if stop.is_set():
+            return
+
+
+class ResourceManager(object):
+    """
+    Keep track of resources opened by connections, cap their number and
+    reap idle ones (least recently used first). Reaped resources are
+    reopened transparently by L{Connection} lazy properties on next access.
+
+    Shell channels and rpyc connections carry state (shell session, remote
+    objects) which is lost when they are reopened, so they (and transports
+    they ride on) are only closed when evict_stateful is set. Resources
+    pinned by L{Connection.pin} (e.g. cli during recv_exit_status) or locked
+    by another thread, as well as cli with running exec_command, are never
+    closed. The limits are therefore soft: they are exceeded (with a warning)
+    when nothing else can be closed.
+    """
+    def __init__(self, max_transports=None, max_sessions=None,
+                 idle_timeout=None, evict_stateful=False):
+        """
+        Create resource manager
+
+        @param max_transports: maximum number of simultaneously open
+                               transports (cli, pbm), None for unlimited
+        @type max_transports: int
+
+        @param max_sessions: maximum number of simultaneously open sessions
+                             (sftp, channel, rpyc), None for unlimited
+        @type max_sessions: int
+
+        @param idle_timeout: close resources which were not used for this
+                             number of seconds, None to disable
+        @type idle_timeout: int
+
+        @param evict_stateful: allow closing shell channels and rpyc
+                               connections (their state is lost)
+        @type evict_stateful: bool
+        """
+        self.logger = logging.getLogger('stitches.resources')
+        self.max_transports = max_transports
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.evict_stateful = evict_stateful
+        self.lock = threading.RLock()
+        # (connection, name) -> last access time, LRU first
+        self.resources = collections.OrderedDict()
+        self.reaper = None
+        self.reaper_stop = threading.Event()
+        # limits already reported as exceeded
+        self.warned = set()
+
+    def __len__(self):
+        return len(self.resources)
+
+    def count(self, kind):
+        """
+        Count open resources of the kind
+
+        @param kind: L{TRANSPORTS} or L{SESSIONS}
+        @type kind: tuple
+
+        @return: number of open resources
+        @rtype: int
+        """
+        with self.lock:
+            return len([key for key in self.resources if key[1] in kind])
+
+    def opened(self, connection, name):
+        """
+        Register a newly opened resource and close the least recently used
+        resources of other connections if the limit is exceeded
+
+        @param connection: connection owning the resource
+        @type connection: L{Connection}
+
+        @param name: resource name
+        @type name: str
+        """
+        self.touch(connection, name)
+        self._start_reaper()
+        if name in TRANSPORTS:
+            kind, limit = TRANSPORTS, self.max_transports
+        else:
+            kind, limit = SESSIONS, self.max_sessions
+        if limit is None:
+            return
+        with self.lock:
+            excess = self.count(kind) - limit
+            candidates = [key for key in self.resources
+                          if key[1] in kind and key[0] is not connection]
+        if excess > 0 and self._close(candidates, excess) < excess:
+            self._exceeded(kind, limit, connection)
+
+    def touch(self, connection, name):
+        """
+        Mark the resource (and the resources it depends on) as recently used
+
+        @param connection: connection owning the resource
+        @type connection: L{Connection}
+
+        @param name: resource name
+        @type name: str
+        """
+        now = time.time()
+        with self.lock:
+            for res in PARENTS.get(name, ()) + (name,):
+                key = (connection, res)
+                if res == name or key in self.resources:
+                    self.resources.pop(key, None)
+                    self.resources[key] = now
+
+    def released(self, connection, name):
+        """
+        Forget a closed resource
+
+        @param connection: connection owning the resource
+        @type connection: L{Connection}
+
+        @param name: resource name
+        @type name: str
+        """
+        with self.lock:
+            self.resources.pop((connection, name), None)
+
+    def reap_idle(self):
+        """
+        Close resources which were not used for idle_timeout seconds
+        """
+        if self.idle_timeout is None:
+            return
+        deadline = time.time() - self.idle_timeout
+        with self.lock:
+            candidates = []
+            for key, last_used in self.resources.items():
+                if last_used >= deadline:
+                    # ordered by access time, the rest is fresher
+                    break
+                candidates.append(key)
+        self._close(candidates)
+
+    def _exceeded(self, kind, limit, connection):
+        """
+        Report a limit which could not be kept, warn once per limit
+
+        @param kind: L{TRANSPORTS} or L{SESSIONS}
+        @type kind: tuple
+
+        @param limit: the limit
+        @type limit: int
+
+        @param connection: connection which opened the resource
+        @type connection: L{Connection}
+        """
+        kind_name = 'transports' if kind is TRANSPORTS else 'sessions'
+        with self.lock:
+            warn = kind_name not in self.warned
+            self.warned.add(kind_name)
+        if warn:
+            self.logger.warning("Exceeding %s limit (%s) for %s: other %s "
+                                "are stateful (shell channel, rpyc; see "
+                                "evict_stateful) or in use",
+                                kind_name, limit, connection.hostname,
+                                kind_name)
+        else:
+            self.logger.debug("Exceeding %s limit (%s) for %s",
+                              kind_name, limit, connection.hostname)
+
+    def stop(self):
+        """
+        Stop the background reaper and wait for it to finish
+        """
+        self.reaper_stop.set()
+        reaper = self.reaper
+        if reaper is not None and reaper is not threading.current_thread():
+            reaper.join()
+
+    def _start_reaper(self):
+        """
+        Start the background reaper if idle reaping is enabled
+        """
+        if self.idle_timeout is None:
+            return
+        with self.lock:
+            if self.reaper is not None or self.reaper_stop.is_set():
+                return
+            self.reaper = threading.Thread(target=_reaper,
+                                           args=(weakref.ref(self),
+                                                 self.reaper_stop),
+                                           name='stitches-reaper')
+            self.reaper.daemon = True
+            self.reaper.start()
+            _MANAGERS.add(self)
+
+    def _close(self, candidates, limit=None):
+        """
+        Close resources skipping the ones which are in use or stateful
+
+        @param candidates: (connection, resource name) pairs, LRU first
+        @type candidates: list
+
+        @param limit: maximum number of resources to close, None for all
+        @type limit: int
+
+        @return: number of resources closed
+        @rtype: int
+        """
+        closed = 0
+        for connection, name in candidates:
+            if limit is not None and closed >= limit:
+                break
+            # never wait for a connection busy in another thread
+            if not connection.resource_lock.acquire(False):
+                continue
+            try:
+                if (connection, name) not in self.resources or \
+                        connection.is_busy(name) or \
+                        (not self.evict_stateful and
+                         connection.is_stateful(name)):
+                    continue
+                self.logger.debug("Reaping %s of %s",
+                                  name, connection.hostname)
+                connection.close_resource(name)
+                closed += 1
+            finally:
+                connection.resource_lock.release()
+        return closed
@@ -4,36 +4,127 @@ Class to represent the whole setup (a bunch of nodes)
 
 
 import logging
+import sys
+import threading
 import yaml
 
 from stitches.connection import Connection
+from stitches.resources import ResourceManager
 
 
 class Structure(object):
     """
     Stateful object to represent whole setup
     """
-    def __init__(self):
+    def __init__(self, max_transports=None, max_sessions=None,
+                 idle_timeout=None, evict_stateful=False, max_output=None,
+                 workers=16):
+        """
+        Create structure
+
+        The limits and idle_timeout do not apply to shell channels, rpyc
+        connections and the transports they ride on unless evict_stateful is
+        set, nor to resources in use (pinned, running exec_command): the
+        limits are exceeded with a warning instead.
+
+        @param max_transports: maximum number of simultaneously open
+                               transports (cli, pbm), None for unlimited
+        @type max_transports: int
+
+        @param max_sessions: maximum number of simultaneously open sessions
+                             (sftp, channel, rpyc), None for unlimited
+        @type max_sessions: int
+
+        @param idle_timeout: close resources which were not used for this
+                             number of seconds, None to disable
+        @type idle_timeout: int
+
+        @param evict_stateful: allow closing shell channels and rpyc
+                               connections (their state is lost)
+        @type evict_stateful: bool
+
+        @param max_output: keep at most this number of bytes of the last
+                           command output per connection, None for unlimited
+        @type max_output: int
+
+        @param workers: number of threads closing connections in parallel
+        @type workers: int
+        """
         self.logger = logging.getLogger('stitches.structure')
         self.Instances = {}
         self.config = {}
+        self.resources = ResourceManager(max_transports, max_sessions,
+                                         idle_timeout, evict_stateful)
+        self.max_output = max_output
+        self.workers = workers
 
     def __del__(self):
         """
-        Close all connections
+        Close all connections, serially at interpreter shutdown
+        """
+        self.resources.stop()
+        # threads can't be started at interpreter shutdown (and it can't be
+        # detected on python2)
+        is_finalizing = getattr(sys, 'is_finalizing', lambda: True)
+        self.disconnect_all(workers=1 if is_finalizing() else None)
+
+    def connections(self):
+        """
+        List all connections
+
+        @return: connections of all roles
+        @rtype: list
+        """
+        return [connection for role in self.Instances.keys()
+                for connection in self.Instances[role]]
+
+    def disconnect_all(self, workers=None):
+        """
+        Close all opened connections in parallel (serially if threads
+        can't be started)
+
+        @param workers: number of threads to use, self.workers by default
+        @type workers: int
+        """
+        connections = [connection for connection in self.connections()
+                       if connection.is_connected()]
+        workers = min(workers or self.workers, len(connections))
+
+        def disconnect(chunk):
+            """ Close connections of the chunk """
+            for connection in chunk:
+                if not connection.disconnect():
+                    self.logger.warning('Failed to cleanly disconnect '
+                                        'from %s', connection.hostname)
+
+        if workers <= 1:
+            disconnect(connections)
+            return
+        threads = []
+        for i in range(workers):
+            chunk = connections[i::workers]
+            thread = threading.Thread(target=disconnect, args=(chunk,))
+            try:
+                thread.start()
+                threads.append(thread)
+            except RuntimeError:
+                # e.g. interpreter shutdown
+                disconnect(chunk)
+        for thread in threads:
+            thread.join()
+
+    def reap_idle(self):
+        """
+        Close resources which were not used for idle_timeout seconds
         """
-        for role in self.Instances.keys():
-            for connection in self.Instances[role]:
-                connection.sftp.close()
-                connection.cli.close()
+        self.resources.reap_idle()
 
     def reconnect_all(self):
         """
         Re-establish connection to all instances
         """
-        for role in self.Instances.keys():
-            for connection in self.Instances[role]:
-                connection.reconnect()
+        for connection in self.connections():
+            connection.reconnect()
 
     def add_instance(self,
                     role,
@@ -69,7 +160,9 @@ class Structure(object):
         self.Instances[role].append(Connection(instance,
                                                username,
                                                key_filename,
-                                               output_shell=output_shell))
+                                               output_shell=output_shell,
+                                               resource_manager=self.resources,
+                                               max_output=self.max_output))
 
     def setup_from_yamlfile(self, yamlfile, output_shell=False):
         """
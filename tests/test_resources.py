@@ -0,0 +1,360 @@
+""" ResourceManager tests """
+
+import io
+import threading
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from stitches.connection import Connection, TailBuffer, lazyprop, read_tail
+from stitches.resources import ResourceManager, TRANSPORTS, SESSIONS
+from stitches.structure import Structure
+
+
+def open_(connection, *names):
+    """ Access (and open if needed) lazy resources of the connection """
+    return [getattr(connection, name) for name in names][-1]
+
+
+class FakeResource(object):
+    """ Resource recording whether it was closed """
+    def __init__(self, name, fail=False):
+        self.name = name
+        self.closed = False
+        self.fail = fail
+
+    def close(self):
+        """ Close resource """
+        self.closed = True
+        if self.fail:
+            raise IOError("close failed")
+
+
+class FakeConnection(Connection):
+    """ Connection with fake lazy resources """
+    def __init__(self, hostname, manager=None, **kwargs):
+        Connection.__init__(self, hostname, resource_manager=manager,
+                            **kwargs)
+        self.created = []
+
+    def _create(self, name):
+        """ Create fake resource """
+        resource = FakeResource(name)
+        self.created.append(resource)
+        return resource
+
+    @lazyprop
+    def cli(self):
+        return self._create('cli')
+
+    @lazyprop
+    def sftp(self):
+        open_(self, 'cli')
+        return self._create('sftp')
+
+    @lazyprop
+    def channel(self):
+        open_(self, 'cli')
+        return self._create('channel')
+
+    @lazyprop
+    def pbm(self):
+        if self.disable_rpyc:
+            return None
+        return self._create('pbm')
+
+    @lazyprop
+    def rpyc(self):
+        if self.disable_rpyc:
+            return None
+        open_(self, 'pbm', 'cli')
+        return self._create('rpyc')
+
+
+class FakeChannel(object):
+    """ Command channel producing output, finishing after a few polls """
+    def __init__(self, chunks, on_poll=None):
+        self.chunks = list(chunks)
+        self.polls = 0
+        self.on_poll = on_poll
+        self.closed = False
+        self.eof_received = False
+
+    def recv_ready(self):
+        return bool(self.chunks)
+
+    def recv(self, size):
+        return self.chunks.pop(0)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def exit_status_ready(self):
+        self.polls += 1
+        if self.on_poll is not None:
+            self.on_poll()
+        return self.polls > 2
+
+    def recv_exit_status(self):
+        return 0
+
+
+class FakeFile(io.BytesIO):
+    """ ChannelFile replacement """
+    def __init__(self, channel, data=b''):
+        io.BytesIO.__init__(self, data)
+        self.channel = channel
+
+
+class FakeCli(FakeResource):
+    """ SSH client running commands on FakeChannel """
+    def __init__(self, channel):
+        FakeResource.__init__(self, 'cli')
+        self.channel = channel
+
+    def exec_command(self, command, bufsize=-1, get_pty=False):
+        return (FakeFile(self.channel), FakeFile(self.channel, b'tail'),
+                FakeFile(self.channel))
+
+
+def opened(manager):
+    """ List (hostname, resource name) pairs registered in manager """
+    return [(conn.hostname, name) for conn, name in manager.resources]
+
+
+class TestResourceManager(unittest.TestCase):
+    """ ResourceManager tests """
+    def test_lru_eviction(self):
+        manager = ResourceManager(max_transports=2)
+        conns = [FakeConnection('h%d' % i, manager) for i in range(3)]
+        open_(conns[0], 'cli')
+        open_(conns[1], 'cli')
+        open_(conns[0], 'cli')
+        open_(conns[2], 'cli')
+        self.assertEqual(opened(manager), [('h0', 'cli'), ('h2', 'cli')])
+        self.assertTrue(conns[1].created[0].closed)
+        # reopened transparently
+        open_(conns[1], 'cli')
+        self.assertEqual(len(conns[1].created), 2)
+        self.assertEqual(manager.count(TRANSPORTS), 2)
+
+    def test_own_resources_not_evicted(self):
+        manager = ResourceManager(max_transports=1)
+        conn = FakeConnection('h0', manager)
+        open_(conn, 'cli')
+        open_(conn, 'pbm')
+        self.assertEqual(manager.count(TRANSPORTS), 2)
+        self.assertFalse(any(res.closed for res in conn.created))
+
+    def test_dependents_closed_with_parent(self):
+        manager = ResourceManager(max_transports=1)
+        first = FakeConnection('h0', manager)
+        open_(first, 'sftp')
+        open_(FakeConnection('h1', manager), 'cli')
+        self.assertTrue(all(res.closed for res in first.created))
+        self.assertFalse(first.is_connected())
+        self.assertEqual(opened(manager), [('h1', 'cli')])
+
+    def test_session_touch_refreshes_transport(self):
+        manager = ResourceManager(max_transports=2)
+        conns = [FakeConnection('h%d' % i, manager) for i in range(3)]
+        open_(conns[0], 'sftp')
+        open_(conns[1], 'cli')
+        open_(conns[0], 'sftp')
+        open_(conns[2], 'cli')
+        self.assertFalse(conns[0].created[0].closed)
+        self.assertTrue(conns[1].created[0].closed)
+
+    def test_stateful_not_evicted(self):
+        manager = ResourceManager(max_transports=1, max_sessions=1)
+        first = FakeConnection('h0', manager)
+        open_(first, 'channel')
+        second = FakeConnection('h1', manager)
+        open_(second, 'channel')
+        self.assertFalse(any(res.closed for res in first.created))
+        self.assertEqual(manager.count(SESSIONS), 2)
+
+    def test_stateful_evicted_on_request(self):
+        manager = ResourceManager(max_sessions=1, evict_stateful=True)
+        first = FakeConnection('h0', manager)
+        open_(first, 'channel')
+        open_(FakeConnection('h1', manager), 'channel')
+        self.assertTrue(first.created[1].closed)
+        self.assertFalse(first.created[0].closed)
+
+    def test_pinned_not_evicted(self):
+        manager = ResourceManager(max_transports=1)
+        first = FakeConnection('h0', manager)
+        with first.pin('cli'):
+            open_(first, 'cli')
+            open_(FakeConnection('h1', manager), 'cli')
+            self.assertFalse(first.created[0].closed)
+        open_(FakeConnection('h2', manager), 'cli')
+        self.assertTrue(first.created[0].closed)
+
+    def test_locked_not_evicted(self):
+        manager = ResourceManager(max_transports=1)
+        first = FakeConnection('h0', manager)
+        open_(first, 'cli')
+        locked, release = threading.Event(), threading.Event()
+
+        def hold():
+            with first.resource_lock:
+                locked.set()
+                release.wait(10)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait(10)
+        try:
+            open_(FakeConnection('h1', manager), 'cli')
+            self.assertFalse(first.created[0].closed)
+        finally:
+            release.set()
+            thread.join()
+
+    def test_disabled_rpyc_evicts_nothing(self):
+        manager = ResourceManager(max_transports=1, max_sessions=1)
+        first = FakeConnection('h0', manager)
+        open_(first, 'sftp')
+        second = FakeConnection('h1', manager, disable_rpyc=True)
+        self.assertIsNone(second.rpyc)
+        self.assertIsNone(second.pbm)
+        self.assertFalse(any(res.closed for res in first.created))
+        self.assertEqual(len(manager), 2)
+
+    def test_reap_idle(self):
+        manager = ResourceManager(idle_timeout=60)
+        manager.stop()
+        conns = [FakeConnection('h%d' % i, manager) for i in range(2)]
+        open_(conns[0], 'sftp')
+        open_(conns[1], 'cli')
+        for key in list(manager.resources)[:2]:
+            manager.resources[key] -= 120
+        manager.reap_idle()
+        self.assertFalse(conns[0].is_connected())
+        self.assertEqual(opened(manager), [('h1', 'cli')])
+
+    def test_background_reaper(self):
+        manager = ResourceManager(idle_timeout=0.1)
+        conn = FakeConnection('h0', manager)
+        open_(conn, 'sftp')
+        for _ in range(50):
+            if not conn.is_connected():
+                break
+            time.sleep(0.1)
+        self.assertFalse(conn.is_connected())
+        for _ in range(50):
+            if manager.reaper is None:
+                break
+            time.sleep(0.1)
+        self.assertIsNone(manager.reaper)
+
+    def test_close_rpyc_files_failure(self):
+        conn = FakeConnection('h0')
+        open_(conn, 'rpyc')
+        conn.stdin_rpyc = FakeResource('stdin', fail=True)
+        self.assertFalse(conn.close_resource('rpyc'))
+        self.assertTrue(conn.created[-1].closed)
+        self.assertIsNone(conn.stdin_rpyc)
+
+    def test_close_failure_closes_parent(self):
+        manager = ResourceManager(max_transports=1, evict_stateful=True)
+        first = FakeConnection('h0', manager)
+        open_(first, 'rpyc')
+        first.stdin_rpyc = FakeResource('stdin', fail=True)
+        cli = first.created[1]
+        open_(FakeConnection('h1', manager), 'cli')
+        self.assertTrue(cli.closed)
+        self.assertFalse(hasattr(first, '_lazy_cli'))
+        self.assertNotIn(('h0', 'cli'), opened(manager))
+
+    def test_disconnect_failure(self):
+        conn = FakeConnection('h0')
+        open_(conn, 'rpyc', 'sftp', 'channel')
+        conn.stdin_rpyc = FakeResource('stdin', fail=True)
+        self.assertFalse(conn.disconnect())
+        self.assertFalse(conn.is_connected())
+        self.assertTrue(all(res.closed for res in conn.created))
+
+    def test_exec_command_not_evicted(self):
+        manager = ResourceManager(max_transports=1)
+        channel = FakeChannel([b'out'])
+        conn = FakeConnection('h0', manager)
+        cli = FakeCli(channel)
+        conn._create = lambda name: cli
+        conn.exec_command('cmd')
+        open_(FakeConnection('h1', manager), 'cli')
+        self.assertFalse(cli.closed)
+        # output read till EOF
+        channel.chunks = []
+        channel.eof_received = True
+        open_(FakeConnection('h2', manager), 'cli')
+        self.assertTrue(cli.closed)
+
+    def test_exceeded_warned_once(self):
+        manager = ResourceManager(max_sessions=1)
+        with mock.patch.object(manager.logger, 'warning') as warning:
+            for i in range(3):
+                open_(FakeConnection('h%d' % i, manager), 'channel')
+        self.assertEqual(warning.call_count, 1)
+        self.assertEqual(manager.count(SESSIONS), 3)
+
+    def test_recv_exit_status_pins_cli(self):
+        manager = ResourceManager(max_transports=1)
+        other = FakeConnection('h1', manager)
+        channel = FakeChannel([b'a' * 10, b'b' * 10],
+                              on_poll=lambda: open_(other, 'cli'))
+        conn = FakeConnection('h0', manager, max_output=8)
+        cli = FakeCli(channel)
+        conn._create = lambda name: cli
+        with mock.patch('stitches.connection.time.sleep'):
+            self.assertEqual(conn.recv_exit_status('cmd'), 0)
+        self.assertFalse(cli.closed)
+        self.assertEqual(conn.last_stdout, b'bbbbtail')
+        # no longer pinned
+        open_(FakeConnection('h2', manager), 'cli')
+        self.assertTrue(cli.closed)
+
+
+class TestStructure(unittest.TestCase):
+    """ Structure teardown tests """
+    def test_disconnect_all(self):
+        structure = Structure(workers=4)
+        conns = [FakeConnection('h%d' % i, structure.resources)
+                 for i in range(10)]
+        structure.Instances['ROLE'] = conns
+        for conn in conns[:6]:
+            open_(conn, 'sftp')
+        structure.disconnect_all()
+        self.assertFalse(any(conn.is_connected() for conn in conns))
+        self.assertTrue(all(res.closed for conn in conns
+                            for res in conn.created))
+        self.assertEqual(len(structure.resources), 0)
+        self.assertFalse(any(conn.created for conn in conns[6:]))
+
+
+class TestTailBuffer(unittest.TestCase):
+    """ Bounded output tests """
+    def test_limit(self):
+        buf = TailBuffer(5)
+        for chunk in (b'abc', b'defg', b'h'):
+            buf.write(chunk)
+        self.assertEqual(buf.getvalue(), b'defgh')
+
+    def test_zero_limit(self):
+        buf = TailBuffer(0)
+        buf.write(b'abc')
+        self.assertEqual(buf.getvalue(), b'')
+
+    def test_read_tail(self):
+        data = b'x' * 50000 + b'end'
+        self.assertEqual(read_tail(io.BytesIO(data), 5), b'xxend')
+        self.assertEqual(read_tail(io.BytesIO(data)), data)
+
+
+if __name__ == '__main__':
+    unittest.main()